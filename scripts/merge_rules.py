@@ -4,150 +4,197 @@
 优化：纯 set 去重、内存优化、更好的排序
 """
 
+import os
 import time
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 TEMP_DIR = Path("temp")
 OUTPUT_DIR = Path("rules")
 OUTPUT_DIR.mkdir(exist_ok=True)
+MAX_WORKERS = os.cpu_count() or 1
+WRITE_BUFFER_SIZE = 1024 * 1024  # 1MB
+
+# 分类输出顺序（同时也是排序优先级）
+CATEGORIES = ('allow', 'regex', 'domain', 'hosts', 'other')
+
+# 分类只取决于规则开头：前两个字符 -> 候选分类（正则规则单独按首尾字符判断）
+HOSTS_PREFIXES = ('0.0.0.0 ', '127.0.0.1 ', '::1 ')
+PREFIX_CATEGORIES = {
+    '@@': 'allow',
+    '||': 'domain',
+    '0.': 'hosts',
+    '12': 'hosts',
+    '::': 'hosts',
+}
+
+def parse_file(file_path):
+    """在子进程中解析单个文件，返回只含该文件规则的处理器"""
+    processor = RuleProcessor()
+    processor.process_file(file_path)
+    return processor
+
+def merge_results(processor, rule_files, results):
+    """按文件顺序把各文件的解析结果合并到 processor，并显示进度"""
+    for i, (file_path, result) in enumerate(zip(rule_files, results), 1):
+        print(f"[{i:3}/{len(rule_files)}] 处理: {file_path.name:<30}", end='\r')
+        processor.merge(result)
 
 class RuleProcessor:
     def __init__(self):
-        self.rules = set()  # 直接使用 set，Python 的哈希优化足够好
+        # 按分类分别去重：每个分类一个 set，规则只分类一次
+        self.rules = {category: set() for category in CATEGORIES}
         self.stats = {
             'total_lines': 0,
             'comment_lines': 0,
             'duplicates': 0,
             'invalid_lines': 0,
         }
-        self.category_counts = defaultdict(int)
     
     def get_rule_category(self, rule):
-        """快速规则分类"""
-        if rule.startswith('@@'):
-            return 'allow'
-        elif rule.startswith('/') and rule.endswith('/'):
-            return 'regex'
-        elif rule.startswith('||') and rule.endswith('^'):
-            return 'domain'
-        elif rule.startswith(('0.0.0.0 ', '127.0.0.1 ', '::1 ')):
-            return 'hosts'
-        else:
-            return 'other'
+        """快速规则分类：按前两个字符查表确定候选分类，只做必要的精确校验"""
+        category = PREFIX_CATEGORIES.get(rule[:2])
+        if category is None:
+            return 'regex' if rule[0] == '/' and rule[-1] == '/' else 'other'
+        if category == 'allow':
+            return category
+        if category == 'domain':
+            return category if rule[-1] == '^' else 'other'
+        return category if rule.startswith(HOSTS_PREFIXES) else 'other'
     
     def normalize_rule(self, line):
         """标准化规则"""
         # 移除行内注释
         if '!' in line:
-            line = line.split('!', 1)[0]
+            line = line[:line.index('!')]
         
         line = line.strip()
         if not line:
             return None
         
         # 处理 $ 选项
-        if '$' in line:
-            parts = line.split('$', 1)
-            main = parts[0].strip()
-            options = parts[1].strip()
-            # 标准化选项顺序（按字母排序，保证一致性）
-            if ',' in options:
-                opts = sorted([opt.strip() for opt in options.split(',')])
-                options = ','.join(opts)
-            return f"{main}${options}"
+        if '$' not in line:
+            return line
         
-        return line
+        main, _, options = line.partition('$')
+        # 标准化选项顺序（按字母排序，保证一致性）
+        if ',' in options:
+            options = ','.join(sorted(map(str.strip, options.split(','))))
+        else:
+            options = options.lstrip()
+        return f"{main.rstrip()}${options}"
     
-    def process_file(self, file_path):
-        """处理单个文件"""
+    def rule_count(self):
+        """唯一规则总数"""
+        return sum(len(rules) for rules in self.rules.values())
+    
+    def process_lines(self, lines):
+        """批量处理一个文件的所有行"""
+        stats = self.stats
+        stats['total_lines'] += len(lines)
+        
+        lines = [line for line in lines if line]
+        candidates = [line for line in lines if not line.startswith('!')]
+        stats['comment_lines'] += len(lines) - len(candidates)
+        
+        # 不含注释和选项的规则只需 strip，省去一次方法调用
+        normalize_rule = self.normalize_rule
+        normalized = [
+            normalize_rule(line) if '!' in line or '$' in line else line
+            for line in map(str.strip, candidates)
+        ]
+        normalized = [rule for rule in normalized if rule]
+        stats['invalid_lines'] += len(candidates) - len(normalized)
+        
+        # 分类与去重合并为一次遍历：直接放入所属分类的 set
+        before = self.rule_count()
+        rules = self.rules
+        get_rule_category = self.get_rule_category
+        for rule in set(normalized):
+            rules[get_rule_category(rule)].add(rule)
+        stats['duplicates'] += len(normalized) - (self.rule_count() - before)
+    
+    def read_lines(self, file_path):
+        """整文件按字节读入并一次性解码，非 UTF-8 文件直接对同一缓冲区回退到 latin-1"""
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        
+        # 统一换行符（与文本模式的通用换行处理一致）
+        if b'\r' in data:
+            data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    self.stats['total_lines'] += 1
-                    
-                    line = line.rstrip('\n')
-                    if not line:
-                        continue
-                    
-                    if line.startswith('!'):
-                        self.stats['comment_lines'] += 1
-                        continue
-                    
-                    rule = self.normalize_rule(line)
-                    if not rule:
-                        self.stats['invalid_lines'] += 1
-                        continue
-                    
-                    if rule in self.rules:
-                        self.stats['duplicates'] += 1
-                    else:
-                        self.rules.add(rule)
-                        category = self.get_rule_category(rule)
-                        self.category_counts[category] += 1
-                        
+            text = data.decode('utf-8')
         except UnicodeDecodeError:
-            # 尝试其他编码
-            try:
-                with open(file_path, 'r', encoding='latin-1') as f:
-                    for line in f:
-                        self.stats['total_lines'] += 1
-                        
-                        line = line.rstrip('\n')
-                        if not line or line.startswith('!'):
-                            continue
-                        
-                        rule = self.normalize_rule(line)
-                        if rule and rule not in self.rules:
-                            self.rules.add(rule)
-                            category = self.get_rule_category(rule)
-                            self.category_counts[category] += 1
-            except:
-                self.stats['invalid_lines'] += 1
-                print(f"无法解码文件: {file_path.name}")
-    
-    def sort_key(self, rule):
-        """排序键函数"""
-        category = self.get_rule_category(rule)
+            text = data.decode('latin-1')
         
-        # 优先级顺序：allow > regex > domain > hosts > other
-        priority = {
-            'allow': 0,
-            'regex': 1,
-            'domain': 2,
-            'hosts': 3,
-            'other': 4,
-        }.get(category, 5)
+        lines = text.split('\n')
+        if not lines[-1]:
+            lines.pop()
+        return lines
+    
+    def process_file(self, file_path):
+        """处理单个文件"""
+        self.process_lines(self.read_lines(file_path))
+    
+    def merge(self, other):
+        """合并另一个处理器的结果，跨处理器的重复规则计入 duplicates"""
+        added = 0
+        for category, rules in other.rules.items():
+            before = len(self.rules[category])
+            self.rules[category] |= rules
+            added += len(self.rules[category]) - before
+        
+        for key, value in other.stats.items():
+            self.stats[key] += value
+        self.stats['duplicates'] += other.rule_count() - added
+    
+    def iter_sorted_rules(self, category):
+        """按输出顺序逐批产出某分类的规则：允许规则按内容，其他规则按长度再按内容
         
-        # 对于允许规则，按原样排序
+        分类间的优先级由 CATEGORIES 的顺序决定。非允许规则先按长度分桶，
+        各桶按内容排序后依长度顺序产出，写完即释放，不拼接成完整的排序列表
+        """
+        rules = self.rules[category]
         if category == 'allow':
-            return (priority, rule)
+            yield sorted(rules)
+            return
         
-        # 其他规则按长度和内容排序
-        return (priority, len(rule), rule)
+        buckets = defaultdict(list)
+        for rule in rules:
+            buckets[len(rule)].append(rule)
+        
+        for length in sorted(buckets):
+            bucket = buckets.pop(length)
+            bucket.sort()
+            yield bucket
     
     def save_rules(self, output_path):
-        """保存合并后的规则"""
-        print(f"正在排序 {len(self.rules):,} 条规则...")
-        
-        sorted_rules = sorted(self.rules, key=self.sort_key)
+        """保存合并后的规则（逐个分类、逐个长度桶写出，不生成排序后的完整列表）"""
+        total = self.rule_count()
+        print(f"正在排序并写入 {total:,} 条规则...")
         
-        print(f"正在写入文件...")
-        with open(output_path, 'w', encoding='utf-8', newline='\n') as f:
+        # 二进制模式写出：每段文本只做一次 UTF-8 编码，绕过文本层的编码器和换行处理
+        with open(output_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
             # 文件头
-            f.write(f"! 规则合并文件\n")
-            f.write(f"! 生成时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"! 总规则数: {len(sorted_rules):,}\n")
-            f.write("!\n")
+            header = (
+                "! 规则合并文件\n"
+                f"! 生成时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+                f"! 总规则数: {total:,}\n"
+                "!\n"
+            )
+            f.write(header.encode('utf-8'))
             
-            # 按分类写入
-            current_category = None
-            for rule in sorted_rules:
-                category = self.get_rule_category(rule)
-                if category != current_category:
-                    f.write(f"\n! === {category.upper()} 规则 ({self.category_counts[category]:,}) ===\n")
-                    current_category = category
-                f.write(f"{rule}\n")
+            # 按分类写入：每个长度桶拼接成一段文本整体写入，不再逐条格式化
+            for category in CATEGORIES:
+                count = len(self.rules[category])
+                if not count:
+                    continue
+                f.write(f"\n! === {category.upper()} 规则 ({count:,}) ===\n".encode('utf-8'))
+                for batch in self.iter_sorted_rules(category):
+                    f.write('\n'.join(batch).encode('utf-8'))
+                    f.write(b'\n')
     
     def print_stats(self):
         """打印统计信息"""
@@ -158,12 +205,12 @@ class RuleProcessor:
         print(f"注释行数: {self.stats['comment_lines']:,}")
         print(f"重复规则: {self.stats['duplicates']:,}")
         print(f"无效行数: {self.stats['invalid_lines']:,}")
-        print(f"唯一规则: {len(self.rules):,}")
+        print(f"唯一规则: {self.rule_count():,}")
         print("\n规则分类:")
         print("-"*60)
-        total = sum(self.category_counts.values())
-        for category in ['allow', 'regex', 'domain', 'hosts', 'other']:
-            count = self.category_counts[category]
+        total = self.rule_count()
+        for category in CATEGORIES:
+            count = len(self.rules[category])
             if count > 0:
                 percentage = count / total * 100
                 print(f"  {category:10}: {count:>8,} ({percentage:5.1f}%)")
@@ -185,12 +232,15 @@ def main():
     
     print(f"找到 {len(rule_files)} 个规则文件")
     
-    # 处理文件
+    # 处理文件：多进程并行解析，主进程按文件顺序合并
     processor = RuleProcessor()
+    workers = min(MAX_WORKERS, len(rule_files))
     
-    for i, file_path in enumerate(rule_files, 1):
-        print(f"[{i:3}/{len(rule_files)}] 处理: {file_path.name:<30}", end='\r')
-        processor.process_file(file_path)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            merge_results(processor, rule_files, executor.map(parse_file, rule_files))
+    else:
+        merge_results(processor, rule_files, map(parse_file, rule_files))  # 只有一个工作进程时不创建进程池
     
     print()  # 换行
     processor.print_stats()
@@ -202,12 +252,17 @@ def main():
     
     # 保存统计
     stats_file = OUTPUT_DIR / "merge_stats.txt"
+    lines = [
+        f"合并时间: {time.strftime('%Y-%m-%d %H:%M:%S')}",
+        f"源文件数: {len(rule_files)}",
+        f"最终规则数: {processor.rule_count():,}",
+    ]
+    # 与原格式一致，数量为 0 的分类也写出
+    for category in CATEGORIES:
+        lines.append(f"{category}: {len(processor.rules[category])}")
     with open(stats_file, 'w', encoding='utf-8') as f:
-        f.write(f"合并时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-        f.write(f"源文件数: {len(rule_files)}\n")
-        f.write(f"最终规则数: {len(processor.rules):,}\n")
-        for category, count in processor.category_counts.items():
-            f.write(f"{category}: {count}\n")
+        f.write('\n'.join(lines))
+        f.write('\n')
     
     elapsed = time.time() - start_time
     print(f"\n总耗时: {elapsed:.1f}秒")
@@ -4,28 +4,51 @@
 优化：确定性算法、Git友好、性能优化
 """
 
+import os
+import re
 import time
+import heapq
+from bisect import bisect_right
+from itertools import accumulate, islice
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
 TARGET_RULES = 150000
 MIN_RULES = 100000
 MAX_RULES = 200000
+MAX_WORKERS = os.cpu_count() or 1
 
 # 重要关键词（提高保留优先级）
-IMPORTANT_KEYWORDS = {
+IMPORTANT_KEYWORDS = frozenset({
     'doubleclick', 'google-analytics', 'facebook', 'tracking',
     'adsystem', 'adservice', 'adserver', 'analytics',
     'cookie', 'beacon', 'pixel', 'metrics', 'telemetry',
     'spyware', 'malware', 'phishing', 'malicious',
-}
+})
 
 # 通用域名（降低优先级）
-COMMON_DOMAINS = {
+COMMON_DOMAINS = frozenset({
     'google', 'youtube', 'facebook', 'twitter', 'instagram',
     'amazon', 'microsoft', 'apple', 'cloudflare', 'akamai',
-}
+})
+
+# 批量统计命中时按固定顺序遍历的关键词元组（重要关键词、通用域名）
+KEYWORD_GROUPS = (tuple(sorted(IMPORTANT_KEYWORDS)), tuple(sorted(COMMON_DOMAINS)))
+
+# 纯域名阻止规则 ||example.com^（不含路径、通配符和 $ 选项），按行捕获域名部分
+DOMAIN_RULE_RE = re.compile(r'^\|\|([a-z0-9_.-]+)\^$', re.IGNORECASE | re.MULTILINE)
+# 被 $badfilter 禁用的纯域名规则，捕获域名部分
+BADFILTER_DOMAIN_RE = re.compile(r'^\|\|([a-z0-9_.-]+)\^\$.*badfilter', re.IGNORECASE | re.MULTILINE)
+# 以 @@|| 开头的例外规则（不论是否带选项或路径），捕获域名部分
+ALLOW_DOMAIN_RE = re.compile(r'^@@\|\|([a-z0-9_.-]+)', re.IGNORECASE | re.MULTILINE)
+
+def score_chunk(rules):
+    """在子进程中为一段规则评分，返回该段有序的 (score, rule) 列表"""
+    return RuleOptimizer().rank_chunk(rules)
 
 class RuleOptimizer:
+    __slots__ = ('allow_rules', 'block_rules', 'stats')
+    
     def __init__(self):
         self.allow_rules = []   # 允许规则（全部保留）
         self.block_rules = []   # 阻止规则（需要筛选）
@@ -33,6 +56,7 @@ class RuleOptimizer:
             'total': 0,
             'allow': 0,
             'block': 0,
+            'redundant': 0,
             'selected': 0,
         }
     
@@ -40,52 +64,123 @@ class RuleOptimizer:
         """加载规则文件"""
         print(f"加载规则文件: {input_file}")
         
-        with open(input_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('!'):
-                    continue
-                
-                self.stats['total'] += 1
-                
-                if line.startswith('@@'):
-                    self.allow_rules.append(line)
-                    self.stats['allow'] += 1
-                else:
-                    self.block_rules.append(line)
-                    self.stats['block'] += 1
+        # 整文件按字节读入后在 C 层切分；注释和空行在字节层面过滤，只解码保留下来的规则
+        with open(input_file, 'rb') as f:
+            lines = f.read().split(b'\n')
+        
+        rules = [line for line in map(bytes.strip, lines) if line and line[0] != 0x21]  # '!'
+        allow_rules = [rule.decode('utf-8') for rule in rules if rule[:2] == b'@@']
+        block_rules = [rule.decode('utf-8') for rule in rules if rule[:2] != b'@@']
+        
+        self.allow_rules += allow_rules
+        self.block_rules += block_rules
+        self.stats['total'] += len(rules)
+        self.stats['allow'] += len(allow_rules)
+        self.stats['block'] += len(block_rules)
         
         print(f"加载完成: 总共 {self.stats['total']:,} 条规则")
         print(f"  允许规则: {self.stats['allow']:,}")
         print(f"  阻止规则: {self.stats['block']:,}")
     
-    def calculate_rule_score(self, rule):
+    def collapse_subdomains(self, rules):
         """
-        计算规则评分（分数越低越重要）
+        从选中的阻止规则中移除已被上级域名规则覆盖的子域名规则
+        例如 ||example.com^ 也被选中时，||ads.example.com^ 是多余的
+        只在选中结果上执行，被移除规则的上级规则一定保留在输出中；
+        上级规则被 $badfilter 禁用，或向上查找途中（含上级本身）遇到 @@|| 例外规则时不移除
+        所有纯域名规则的域名放入一个 set，每条规则只需按 '.' 逐级查找上级域名，
+        而不是两两比较
+        """
+        # 所有规则拼成一段文本，由正则在 C 层一次性找出全部纯域名规则
+        names = DOMAIN_RULE_RE.findall('\n'.join(rules))
+        domains = set(name.lower() for name in names)
+        
+        block_text = '\n'.join(self.block_rules)
+        if 'badfilter' in block_text:
+            domains -= set(name.lower() for name in BADFILTER_DOMAIN_RE.findall(block_text))
+        excepted = set(name.lower() for name in ALLOW_DOMAIN_RE.findall('\n'.join(self.allow_rules)))
+        
+        redundant = set()
+        for name in names:
+            domain = name.lower()
+            pos = domain.find('.')
+            while pos >= 0:
+                parent = domain[pos + 1:]
+                if parent in excepted:
+                    break  # 例外规则放行了这一级，子域名规则仍然需要
+                if parent in domains:
+                    redundant.add(f"||{name}^")
+                    break
+                pos = domain.find('.', pos + 1)
+        
+        self.stats['redundant'] += len(redundant)
+        
+        if not redundant:
+            return rules
+        return [rule for rule in rules if rule not in redundant]
+    
+    def count_keyword_hits(self, rules):
+        """
+        批量统计每条规则命中的重要关键词数和通用域名数（每个关键词每条规则最多计一次）
+        所有规则拼成一段文本，每个关键词用 str.find 在 C 层扫描一遍，
+        只有命中位置才回到 Python 处理，而不是对每条规则逐个关键词做子串查找
+        """
+        # 整段文本只做一次小写转换，不再为每条规则分配小写副本
+        joined = '\n'.join(rules)
+        text = joined.lower()
+        if len(text) == len(joined):
+            lowered = rules
+        else:
+            # 极少数字符（如 'İ'）小写后会变长，此时按规则逐条转换以保证偏移正确
+            lowered = [rule.lower() for rule in rules]
+            text = '\n'.join(lowered)
+        
+        # starts[i] 为第 i 条规则在文本中的起始位置，末尾多一个哨兵
+        starts = [0]
+        starts += accumulate(len(rule) + 1 for rule in lowered)
+        
+        counts = []
+        for keywords in KEYWORD_GROUPS:
+            hits = [0] * len(rules)
+            for keyword in keywords:
+                pos = text.find(keyword)
+                while pos >= 0:
+                    idx = bisect_right(starts, pos) - 1
+                    hits[idx] += 1
+                    # 该规则已命中，直接从下一条规则开始继续查找
+                    pos = text.find(keyword, starts[idx + 1])
+            counts.append(hits)
+        
+        return counts[0], counts[1]
+    
+    def calculate_rule_score(self, rule, important_hits, common_hits):
+        """
+        计算规则评分（分数越低越重要），无效规则（过于宽泛）返回 None
+        有效性检查与评分在同一次调用中完成，不再单独遍历一遍规则
+        关键词命中数由 count_keyword_hits 批量算出
         注意：这是确定性的，不包含随机性
         """
+        # 过滤过于宽泛的规则
+        stars = rule.count('*')
+        if stars > 3:
+            return None
+        
+        # 移除通配符和特殊字符后检查（'*.*'、'/*/' 等无效模式也在此被过滤）
+        clean = rule.replace('*', '').replace('.', '').replace('^', '').replace('/', '').strip()
+        if len(clean) < 3:
+            return None
+        
         score = 0
-        rule_lower = rule.lower()
         
         # 基础评分
-        if rule.startswith('||') and rule.endswith('^'):
+        if rule[:2] == '||' and rule[-1] == '^':
             score -= 50  # 域名规则优先
         
-        # 重要关键词检查（累积加分，不全用break）
-        important_hits = 0
-        for keyword in IMPORTANT_KEYWORDS:
-            if keyword in rule_lower:
-                important_hits += 1
-        
+        # 重要关键词（累积加分）
         if important_hits > 0:
             score -= 30 * min(important_hits, 3)  # 最多减90分
         
-        # 通用域名检查
-        common_hits = 0
-        for domain in COMMON_DOMAINS:
-            if domain in rule_lower:
-                common_hits += 1
-        
+        # 通用域名
         if common_hits > 0:
             score += 20 * min(common_hits, 2)  # 最多加40分
         
@@ -97,7 +192,7 @@ class RuleOptimizer:
             score += 15  # 过长规则降低优先级
         
         # 规则复杂度
-        if '*' in rule:
+        if stars:
             score += 5  # 通配符规则降低优先级
         
         if '$' in rule:
@@ -107,54 +202,58 @@ class RuleOptimizer:
                 score -= 20  # 重要标记规则优先
         
         # 正则表达式规则
-        if rule.startswith('/') and rule.endswith('/'):
+        if rule[0] == '/' and rule[-1] == '/':
             score += 10  # 正则规则降低优先级
         
         return score
     
-    def is_rule_effective(self, rule):
-        """检查规则是否有效（不过于宽泛）"""
-        # 过滤过于宽泛的规则
-        if rule.count('*') > 3:
-            return False
+    def rank_chunk(self, rules):
+        """为一段规则评分，返回按 (score, rule) 升序排列的全部有效规则"""
+        important_hits, common_hits = self.count_keyword_hits(rules)
         
-        # 移除通配符和特殊字符后检查
-        clean = rule.replace('*', '').replace('.', '').replace('^', '').replace('/', '').strip()
-        if len(clean) < 3:
-            return False
+        # 整列批量评分：map 在 C 层驱动迭代，省去逐条 append 的 Python 循环
+        scores = map(self.calculate_rule_score, rules, important_hits, common_hits)
+        # 使用 (score, rule) 元组，确保相同分数时按字母序排序；评分为 None 的无效规则直接丢弃
+        scored = [item for item in zip(scores, rules) if item[0] is not None]
         
-        # 过滤特定无效模式
-        invalid_patterns = ['*.*', '*', '.*', '/*/']
-        for pattern in invalid_patterns:
-            if pattern == rule:
-                return False
+        # 按分数升序（分数越低越重要），然后按字母序
+        # 元组按字典序比较，无需 key 函数；输入本身基本有序，Timsort 整体排序比堆更快
+        scored.sort()
+        return scored
+    
+    def iter_ranked_rules(self, rules):
+        """按优先级从高到低逐条产出规则"""
+        workers = min(MAX_WORKERS, len(rules))
+        if workers > 1:
+            # 多进程并行：每个进程为一段规则评分并排序，主进程按序归并
+            size = -(-len(rules) // workers)
+            chunks = [rules[i:i + size] for i in range(0, len(rules), size)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parts = list(executor.map(score_chunk, chunks))
+            ranked = heapq.merge(*parts)
+        else:
+            ranked = self.rank_chunk(rules)  # 只有一个工作进程时不创建进程池
         
-        return True
+        return (rule for _, rule in ranked)
     
     def select_top_rules(self, rules, target_count):
-        """选择最优规则（确定性算法）"""
+        """
+        选择最优规则（确定性算法），返回结果不保证顺序，由调用方统一排序
+        选中的子域名规则若被同样选中的上级域名规则覆盖则移除，
+        空出的名额按排名依次补足，直到达到目标数或没有剩余规则
+        """
         if len(rules) <= target_count:
-            return sorted(rules)  # 保持确定性排序
-        
-        # 评分并排序
-        scored = []
-        for rule in rules:
-            if not self.is_rule_effective(rule):
-                continue
-            
-            score = self.calculate_rule_score(rule)
-            # 使用 (score, rule) 元组，确保相同分数时按字母序排序
-            scored.append((score, rule))
-        
-        # 按分数升序（分数越低越重要），然后按字母序
-        scored.sort(key=lambda x: (x[0], x[1]))
+            return self.collapse_subdomains(list(rules))  # 无需评分，全部保留
         
-        # 选择前 target_count 个
-        selected = [rule for _, rule in scored[:target_count]]
-        
-        # 按字母序排序，确保 Git Diff 最小化
-        selected.sort()
-        return selected
+        ranked = self.iter_ranked_rules(rules)
+        selected = list(islice(ranked, target_count))
+        while True:
+            selected = self.collapse_subdomains(selected)
+            missing = target_count - len(selected)
+            refill = list(islice(ranked, missing)) if missing else None
+            if not refill:
+                return selected
+            selected += refill
     
     def optimize(self):
         """执行优化"""
@@ -165,52 +264,57 @@ class RuleOptimizer:
         
         # 2. 计算需要选择的阻止规则数量
         max_block_rules = MAX_RULES - len(selected_allow)
-        target_block_rules = min(
+        target_block_rules = max(0, min(
             max(TARGET_RULES - len(selected_allow), MIN_RULES - len(selected_allow)),
             max_block_rules,
             len(self.block_rules)  # 不能超过实际数量
-        )
+        ))  # 允许规则超过 MAX_RULES 时不再选择阻止规则
         
         print(f"目标规则数: {TARGET_RULES:,}")
         print(f"需要选择的阻止规则: {target_block_rules:,}")
         
         # 3. 选择最优的阻止规则
+        # （被上级域名规则覆盖的子域名规则会被移除，并由后续规则补足）
         selected_block = self.select_top_rules(self.block_rules, target_block_rules)
+        selected_block.sort()  # 按字母序排序，确保 Git Diff 最小化
+        print(f"移除被上级域名覆盖的子域名规则: {self.stats['redundant']:,}")
         
-        # 4. 合并规则
-        final_rules = selected_allow + selected_block
-        self.stats['selected'] = len(final_rules)
+        # 4. 分别返回两类规则，写出时无需再按前缀重新划分
+        self.stats['selected'] = len(selected_allow) + len(selected_block)
         
-        return final_rules, len(selected_block)
+        return selected_allow, selected_block
     
-    def save_rules(self, rules, output_file):
+    def save_rules(self, allow_rules, block_rules, output_file):
         """保存优化后的规则"""
         print(f"\n保存优化规则到: {output_file}")
         
-        with open(output_file, 'w', encoding='utf-8', newline='\n') as f:
-            # 文件头
-            f.write("! 优化规则文件\n")
-            f.write(f"! 生成时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"! 原始规则: {self.stats['total']:,}\n")
-            f.write(f"! 优化后规则: {self.stats['selected']:,}\n")
-            f.write(f"! 精简比例: {1 - self.stats['selected']/self.stats['total']:.1%}\n")
-            f.write("!\n\n")
-            
-            # 允许规则
-            if self.stats['allow'] > 0:
-                f.write("! === 允许规则 ===\n")
-                for rule in rules:
-                    if rule.startswith('@@'):
-                        f.write(f"{rule}\n")
-                f.write("\n")
-            
-            # 阻止规则
-            f.write("! === 阻止规则 ===\n")
-            for rule in rules:
-                if not rule.startswith('@@'):
-                    f.write(f"{rule}\n")
-        
-        print(f"保存完成: {len(rules):,} 条规则")
+        # 文件头与各分区按行收集到一个列表，最后一次性拼接写出
+        lines = [
+            "! 优化规则文件",
+            f"! 生成时间: {time.strftime('%Y-%m-%d %H:%M:%S')}",
+            f"! 原始规则: {self.stats['total']:,}",
+            f"! 优化后规则: {self.stats['selected']:,}",
+            f"! 精简比例: {1 - self.stats['selected']/self.stats['total']:.1%}",
+            "!",
+            "",
+        ]
+        
+        # 允许规则
+        if allow_rules:
+            lines.append("! === 允许规则 ===")
+            lines += allow_rules
+            lines.append("")
+        
+        # 阻止规则
+        lines.append("! === 阻止规则 ===")
+        lines += block_rules
+        
+        # 二进制模式写出：整个文件只做一次 UTF-8 编码，绕过文本层的编码器和换行处理
+        with open(output_file, 'wb') as f:
+            f.write('\n'.join(lines).encode('utf-8'))
+            f.write(b'\n')
+        
+        print(f"保存完成: {len(allow_rules) + len(block_rules):,} 条规则")
     
     def print_stats(self, selected_block_count):
         """打印统计信息"""
@@ -220,6 +324,7 @@ class RuleOptimizer:
         print(f"原始总规则: {self.stats['total']:,}")
         print(f"  允许规则: {self.stats['allow']:,} (保留全部)")
         print(f"  阻止规则: {self.stats['block']:,}")
+        print(f"  冗余子域名规则: {self.stats['redundant']:,}")
         print(f"  选择的阻止规则: {selected_block_count:,}")
         print(f"最终规则数: {self.stats['selected']:,}")
         
@@ -244,18 +349,20 @@ def main():
     optimizer = RuleOptimizer()
     optimizer.load_rules(input_file)
     
-    final_rules, selected_block_count = optimizer.optimize()
-    optimizer.save_rules(final_rules, output_file)
-    optimizer.print_stats(selected_block_count)
+    selected_allow, selected_block = optimizer.optimize()
+    optimizer.save_rules(selected_allow, selected_block, output_file)
+    optimizer.print_stats(len(selected_block))
     
     # 保存详细统计
     stats_file = Path("rules/optimization_stats.txt")
     with open(stats_file, 'w', encoding='utf-8') as f:
-        f.write(f"优化时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-        f.write(f"目标规则数: {TARGET_RULES}\n")
-        f.write(f"原始规则数: {optimizer.stats['total']}\n")
-        f.write(f"最终规则数: {optimizer.stats['selected']}\n")
-        f.write(f"精简比例: {1 - optimizer.stats['selected']/optimizer.stats['total']:.1%}\n")
+        f.write(
+            f"优化时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"目标规则数: {TARGET_RULES}\n"
+            f"原始规则数: {optimizer.stats['total']}\n"
+            f"最终规则数: {optimizer.stats['selected']}\n"
+            f"精简比例: {1 - optimizer.stats['selected']/optimizer.stats['total']:.1%}\n"
+        )
     
     elapsed = time.time() - start_time
     print(f"\n总耗时: {elapsed:.1f}秒")